@@ -0,0 +1,14 @@
+cdef struct _Buf:
+    unsigned char *data
+    Py_ssize_t len
+    Py_ssize_t cap
+
+cdef int _reserve(_Buf *b, Py_ssize_t extra) except -1
+cdef int _put_bytes(_Buf *b, bytes data) except -1
+cdef int _put_int(_Buf *b, object val, int size) except -1
+cdef int _put_string(_Buf *b, object val, Py_ssize_t length, Py_UCS4 elem_type) except -1
+cdef Py_ssize_t _take_length(str fmt, Py_ssize_t *i) except -1
+cdef int _byte(const unsigned char[:] buf, Py_ssize_t off) except -1
+cdef bytes _slice(const unsigned char[:] buf, Py_ssize_t start, object length)
+cdef object _take_int(const unsigned char[:] buf, Py_ssize_t *off)
+cdef object _take_string(const unsigned char[:] buf, Py_ssize_t *off)
@@ -0,0 +1,247 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+# Compiled version of pack() and unpack() from rpc.py. Build it with
+# `make asn1`; rpc.py falls back to the pure Python code without it.
+# Bad input must fail the same way in both, see test_asn1_parity().
+
+from cpython.bytes cimport PyBytes_FromStringAndSize
+from cpython.mem cimport PyMem_Free, PyMem_Realloc
+from cpython.pyport cimport PY_SSIZE_T_MAX
+from libc.string cimport memcpy, memset
+
+from struct import Struct, pack as _struct_pack
+
+# same layouts as rpc.py, used to raise its errors for values the C
+# fast path does not handle
+_ASN_INT = {
+    1: Struct('>HB'),
+    2: Struct('>HH'),
+    4: Struct('>HL'),
+}
+
+
+cdef int _reserve(_Buf *b, Py_ssize_t extra) except -1:
+    cdef Py_ssize_t cap
+    cdef unsigned char *data
+    if b.len + extra <= b.cap:
+        return 0
+    cap = max(b.cap * 2, b.len + extra, 256)
+    data = <unsigned char *>PyMem_Realloc(b.data, cap)
+    if data == NULL:
+        raise MemoryError()
+    b.data = data
+    b.cap = cap
+    return 0
+
+
+cdef int _put_bytes(_Buf *b, bytes data) except -1:
+    _reserve(b, len(data))
+    memcpy(b.data + b.len, <const char *>data, len(data))
+    b.len += len(data)
+    return 0
+
+
+cdef int _put_int(_Buf *b, object val, int size) except -1:
+    cdef unsigned long v
+    cdef int k
+    if type(val) is not int or val < 0 or val >> (size * 8):
+        return _put_bytes(b, _ASN_INT[size].pack(0x0200 | size, val))
+    v = val
+    _reserve(b, 2 + size)
+    b.data[b.len] = 0x02
+    b.data[b.len + 1] = size
+    for k in range(size):
+        b.data[b.len + 2 + k] = (v >> ((size - 1 - k) * 8)) & 0xff
+    b.len += 2 + size
+    return 0
+
+
+cdef int _put_string(_Buf *b, object val, Py_ssize_t length, Py_UCS4 elem_type) except -1:
+    cdef Py_ssize_t valid = len(val)
+    cdef Py_ssize_t elem_size, padding, nb, k
+    cdef unsigned char field_type
+    cdef bytes payload
+
+    assert valid <= length
+    # element size and field type, as _ELEM_SIZE/_FIELD_TYPE in rpc.py
+    if elem_type == u'B':
+        elem_size, field_type = 1, 0x55
+    elif elem_type == u'H':
+        elem_size, field_type = 2, 0x56
+    elif elem_type == u'L':
+        elem_size, field_type = 4, 0x57
+    else:
+        raise KeyError(elem_type)
+    if elem_size == 1 and (type(val) is bytes or type(val) is bytearray):
+        payload = bytes(val)
+    else:
+        payload = _struct_pack('=%d%s' % (valid, elem_type), *val)
+    padding = (length - valid) * elem_size
+
+    nb = 0
+    if valid >= 128:
+        nb = (valid.bit_length() + 7) // 8
+    _reserve(b, 2 + nb)
+    b.data[b.len] = field_type
+    if nb:
+        b.data[b.len + 1] = 0x80 | nb
+        for k in range(nb):
+            b.data[b.len + 2 + k] = (valid >> ((nb - 1 - k) * 8)) & 0xff
+    else:
+        b.data[b.len + 1] = valid
+    b.len += 2 + nb
+
+    _put_int(b, length * elem_size, 4)
+    _put_int(b, padding, 4)
+
+    _put_bytes(b, payload)
+    _reserve(b, padding)
+    memset(b.data + b.len, 0, padding)
+    b.len += padding
+    return 0
+
+
+cdef Py_ssize_t _take_length(str fmt, Py_ssize_t *i) except -1:
+    cdef Py_ssize_t start = i[0]
+    cdef Py_ssize_t n = len(fmt)
+    while i[0] < n and u'0' <= fmt[i[0]] <= u'9':
+        i[0] += 1
+    return int(fmt[start:i[0]])
+
+
+def pack(str fmt, *args):
+    cdef _Buf b
+    cdef Py_ssize_t i = 0
+    cdef Py_ssize_t n = len(fmt)
+    cdef Py_ssize_t n_args = 0
+    cdef Py_ssize_t length
+    cdef Py_UCS4 ch, elem_type
+
+    b.data = NULL
+    b.len = 0
+    b.cap = 0
+    try:
+        while i < n:
+            if n_args >= len(args):
+                raise ValueError("Not enough args supplied")
+            arg = args[n_args]
+            n_args += 1
+            ch = fmt[i]
+            i += 1
+
+            if ch == u'B':
+                _put_int(&b, arg, 1)
+            elif ch == u'H':
+                _put_int(&b, arg, 2)
+            elif ch == u'L':
+                _put_int(&b, arg, 4)
+            elif ch == u's':
+                length = _take_length(fmt, &i)
+                _put_string(&b, arg, length, u'B')
+            elif ch == u'S':
+                if i >= n:
+                    raise IndexError("string index out of range")
+                elem_type = fmt[i]
+                i += 1
+                length = _take_length(fmt, &i)
+                _put_string(&b, arg, length, elem_type)
+            else:
+                raise ValueError("Unknown format char '%s'" % ch)
+
+        if n_args < len(args):
+            raise ValueError("Too many args supplied")
+
+        return PyBytes_FromStringAndSize(<char *>b.data, b.len)
+    finally:
+        PyMem_Free(b.data)
+
+
+cdef int _byte(const unsigned char[:] buf, Py_ssize_t off) except -1:
+    if off == PY_SSIZE_T_MAX:
+        raise IndexError("cannot fit 'int' into an index-sized integer")
+    if off >= buf.shape[0]:
+        raise IndexError("index out of bounds on dimension 1")
+    return buf[off]
+
+
+cdef bytes _slice(const unsigned char[:] buf, Py_ssize_t start, object length):
+    # like buf[start:start + length] in Python: short at the end of buf
+    cdef Py_ssize_t n = buf.shape[0]
+    if start >= n or length <= 0:
+        return b''
+    if length > n - start:
+        length = n - start
+    return PyBytes_FromStringAndSize(<const char *>&buf[start], <Py_ssize_t>length)
+
+
+cdef object _take_int(const unsigned char[:] buf, Py_ssize_t *off):
+    cdef Py_ssize_t o = off[0]
+    cdef Py_ssize_t l_data, k
+    cdef unsigned long long val = 0
+
+    assert _byte(buf, o) == 0x02
+    l_data = _byte(buf, o + 1)
+    o += 2
+    off[0] = o + l_data
+    # a truncated int decodes from the bytes that are there
+    l_data = min(l_data, buf.shape[0] - o)
+    if l_data > 8:
+        return int.from_bytes(_slice(buf, o, l_data), 'big')
+    for k in range(l_data):
+        val = (val << 8) | buf[o + k]
+    return val
+
+
+cdef object _take_string(const unsigned char[:] buf, Py_ssize_t *off):
+    cdef Py_ssize_t o = off[0]
+    cdef Py_ssize_t n = buf.shape[0]
+    cdef int t, n_bytes
+
+    t = _byte(buf, o)
+    assert t in (0x55, 0x56, 0x57)
+    valid = _byte(buf, o + 1)
+    o += 2
+    if valid & 0x80:    # Variable length!
+        n_bytes = valid & 0xf
+        valid = int.from_bytes(_slice(buf, o, n_bytes), 'little')
+        o += n_bytes
+    if t == 0x56:
+        valid <<= 1
+    elif t == 0x57:
+        valid <<= 2
+    # often equals valid + padding, but sometimes not
+    count = _take_int(buf, &o)
+    padding = _take_int(buf, &o)
+
+    if count:
+        assert count == (valid + padding)
+
+    payload = _slice(buf, o, valid)
+    # past the end of buf any offset fails the next read the same way,
+    # unless it does not even fit a Py_ssize_t
+    end = o + valid + padding
+    if end >= PY_SSIZE_T_MAX:
+        off[0] = PY_SSIZE_T_MAX
+    elif end > n:
+        off[0] = n + 1
+    else:
+        off[0] = end
+    return payload
+
+
+def unpack(str fmt, data):
+    cdef const unsigned char[:] buf = memoryview(data)
+    cdef Py_ssize_t off = 0
+    cdef Py_UCS4 ch
+
+    for ch in fmt:
+        if ch != u'n' and ch != u's':
+            raise ValueError("unknown format char %s" % ch)
+
+    out = []
+    for ch in fmt:
+        if ch == u'n':
+            out.append(_take_int(buf, &off))
+        else:
+            out.append(_take_string(buf, &off))
+
+    return out
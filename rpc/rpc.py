@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import os
-import binascii
+import functools
 import struct
 import itertools
 import ipaddress
@@ -10,8 +10,23 @@ import rpc_call_ids
 import rpc_unsol_table
 
 
+_S_BE_L = struct.Struct('>L')
+_S_LE_L = struct.Struct('<L')
+_ASN_INT1 = struct.Struct('>HB')
+_ASN_INT2 = struct.Struct('>HH')
+_ASN_INT4 = struct.Struct('>HL')
+# string count and padding, as two ASN.1 ints
+_ASN_STR_LEN = struct.Struct('>HLHL')
+# string element sizes and the field type tagging them
+_ELEM_SIZE = {'B': 1, 'H': 2, 'L': 4}
+_FIELD_TYPE = {1: 0x55, 2: 0x56, 4: 0x57}
+# message header after the little endian length word: two ASN.1 ints
+# (length, code) and the raw transaction id
+_MSG_HDR = struct.Struct('>2sL2sLL')
+
+
 def asn_int4(val):
-    return b'\x02\x04' + struct.pack('>L', val)
+    return _ASN_INT4.pack(0x0204, val)
 
 
 class XMMRPC(object):
@@ -25,15 +40,17 @@ class XMMRPC(object):
             raise IOError('XMM RPC interface does not exists')
 
         self.fp = os.open(selected_interface, os.O_RDWR | os.O_SYNC)
+        # reused for every read, handle_message() copies out what it keeps
+        self._rx_buf = bytearray(131072)
 
-        # loop over 1..255, excluding 0
-        self.tid_gen = itertools.cycle(range(1, 256))
+        # async transaction ids, looping over 1..255, excluding 0
+        self._tids = itertools.cycle([0x11000100 | i for i in range(1, 256)])
 
         self.attach_allowed = False
 
     def pump(self, is_async=False, have_ack=False, tid_word=None):
-        message = os.read(self.fp, 131072)
-        resp = self.handle_message(message)
+        n = os.readv(self.fp, [self._rx_buf])
+        resp = self.handle_message(memoryview(self._rx_buf)[:n])
 
         desc = resp['type']
 
@@ -52,48 +69,43 @@ class XMMRPC(object):
             cmd = rpc_call_ids.call_ids[cmd]
 
         if is_async:
-            tid = 0x11000101
+            tid_word = next(self._tids)
         else:
-            tid = 0
-
-        tid_word = 0x11000100 | tid
+            tid_word = 0x11000100
 
         total_length = len(body) + 16
-        if tid:
+        if is_async:
             total_length += 6
-        header = struct.pack('<L', total_length) + asn_int4(total_length) + \
-            asn_int4(cmd) + struct.pack('>L', tid_word)
-        if tid:
-            header += asn_int4(tid)
+        header = _S_LE_L.pack(total_length) + asn_int4(total_length) + \
+            asn_int4(cmd) + _S_BE_L.pack(tid_word)
+        if is_async:
+            header += asn_int4(tid_word)
 
-        assert total_length + 4 == len(header) + len(body)
+        total_bytes = len(header) + len(body)
+        assert total_length + 4 == total_bytes
 
-        print(binascii.hexlify(header + body))
+        print(header.hex() + body.hex())
+        # one write() per message: the rpc devices frame on write() calls,
+        # so writev() would send the header and body as two messages
         ret = os.write(self.fp, header + body)
-        if ret < len(header + body):
+        if ret < total_bytes:
             print("write error: %d", ret)
 
+        # a stale response to an earlier call must not be taken as ours
         while True:
             resp = self.pump()
-            if resp['type'] == 'response':
+            if resp['type'] == 'response' and resp['tid'] == tid_word:
                 break
 
         return resp
 
     def handle_message(self, message):
-        length = message[:4]
-        len1_p = message[4:10]
-        code_p = message[10:16]
-        txid = message[16:20]
-        body = message[20:]
+        l0, = _S_LE_L.unpack_from(message, 0)
+        len1_t, l1, code_t, code, txid = _MSG_HDR.unpack_from(message, 4)
+        body = bytes(message[20:])
 
-        assert len1_p.startswith(b'\x02\x04')
-        assert code_p.startswith(b'\x02\x04')
-
-        l0 = struct.unpack('<L', length)[0]
-        l1 = struct.unpack('>L', len1_p[2:])[0]
-        code = struct.unpack('>L', code_p[2:])[0]
-        txid = struct.unpack('>L', txid)[0]
+        assert len1_t == b'\x02\x04'
+        assert code_t == b'\x02\x04'
 
         if l0 != l1:
             print("length mismatch, framing error?")
@@ -133,162 +145,207 @@ def format_unknown(body):
     return ', '.join(out)
 
 
-def _pack_string(val, fmt, elem_type):
-    length_str = ''
-    while len(fmt) and fmt[0].isdigit():
-        length_str += fmt.pop(0)
+def _take_length(fmt, i):
+    start = i
+    while i < len(fmt) and fmt[i].isdigit():
+        i += 1
+    return int(fmt[start:i]), i
+
 
-    length = int(length_str)
+def _pack_string(val, length, elem_type):
     assert len(val) <= length
     valid = len(val)
 
-    elem_size = len(struct.pack(elem_type, 0))
-    field_type = {1: 0x55, 2: 0x56, 4: 0x57}[elem_size]
-    payload = struct.pack('%d%s' % (valid, elem_type), *val)
+    elem_size = _ELEM_SIZE[elem_type]
+    field_type = _FIELD_TYPE[elem_size]
+    payload = struct.pack('=%d%s' % (valid, elem_type), *val)
 
     count = length * elem_size
     padding = (length - valid) * elem_size
 
     if valid < 128:
-        valid_field = struct.pack('B', valid)
+        header = bytes((field_type, valid))
     else:
-        remain = valid
-        valid_field = [0x80]
-        while remain > 0:
-            valid_field[0] += 1
-            valid_field.insert(1, remain & 0xff)
-            remain >>= 8
-
-    field = struct.pack('B', field_type)
-    field += bytes(valid_field)
-    field += pack('LL', count, padding)
-    field += payload
-    field += b'\0' * padding
-    return field
-
-
-def take_asn_int(data):
-    assert data.pop(0) == 0x02
-    l_data = data.pop(0)
-    val = 0
-    for i in range(l_data):
-        val <<= 8
-        val |= data.pop(0)
-    return val
-
-
-def take_string(data):
-    t = data.pop(0)
+        n_bytes = (valid.bit_length() + 7) // 8
+        header = bytes((field_type, 0x80 | n_bytes)) + \
+            valid.to_bytes(n_bytes, 'big')
+
+    return b''.join([header, _ASN_STR_LEN.pack(0x0204, count, 0x0204, padding),
+                     payload, b'\0' * padding])
+
+
+def take_asn_int(data, off=0):
+    assert data[off] == 0x02
+    l_data = data[off + 1]
+    off += 2
+    val = int.from_bytes(data[off:off + l_data], 'big')
+    return val, off + l_data
+
+
+def take_string(data, off=0):
+    t = data[off]
     assert t in [0x55, 0x56, 0x57]
-    valid = data.pop(0)
+    valid = data[off + 1]
+    off += 2
     if valid & 0x80:    # Variable length!
-        value = 0
-        for byte in range(valid & 0xf):  # lol
-            value |= data.pop(0) << (byte * 8)
-        valid = value
+        n_bytes = valid & 0xf  # lol
+        valid = int.from_bytes(data[off:off + n_bytes], 'little')
+        off += n_bytes
     if t == 0x56:
         valid <<= 1
     elif t == 0x57:
         valid <<= 2
     # often equals valid + padding, but sometimes not
-    count = take_asn_int(data)
-    padding = take_asn_int(data)
+    count, off = take_asn_int(data, off)
+    padding, off = take_asn_int(data, off)
 
     if count:
         assert count == (valid + padding)
 
-    payload = data[:valid]
-    for i in range(valid + padding):
-        data.pop(0)  # eek
-    return payload
+    payload = bytes(data[off:off + valid])
+    return payload, off + valid + padding
 
 
 def unpack_unknown(data):
     out = []
-    data = bytearray(data)
+    off = 0
+    data = memoryview(data)
 
-    while len(data):
-        t = data[0]
+    while off < len(data):
+        t = data[off]
         if t == 0x02:
-            out.append(take_asn_int(data))
+            val, off = take_asn_int(data, off)
         elif t in [0x55, 0x56, 0x57]:
-            out.append(take_string(data))
+            val, off = take_string(data, off)
         else:
             raise ValueError("unknown type 0x%x" % t)
+        out.append(val)
 
     return out
 
 
-def unpack(fmt, data):
-    data = bytearray(data)
-    out = []
+_UNPACK_HANDLERS = {
+    'n': take_asn_int,
+    's': take_string,
+}
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_fmt(fmt):
     for ch in fmt:
-        if ch == 'n':
-            val = take_asn_int(data)
-            out.append(val)
-        elif ch == 's':
-            val = take_string(data)
-            out.append(val)
-        else:
+        if ch not in _UNPACK_HANDLERS:
             raise ValueError("unknown format char %s" % ch)
+    return tuple(_UNPACK_HANDLERS[ch] for ch in fmt)
+
+
+def unpack(fmt, data):
+    out = []
+    off = 0
+    data = memoryview(data)
+    for take in _compile_fmt(fmt):
+        val, off = take(data, off)
+        out.append(val)
 
     return out
 
 
 def pack(fmt, *args):
-    out = b''
-    fmt = list(fmt)
-    args = list(args)
-
-    while len(fmt):
-        arg = args.pop(0)
-        ch = fmt.pop(0)
+    parts = []
+    i = 0
+    n_args = 0
+
+    while i < len(fmt):
+        if n_args >= len(args):
+            raise ValueError("Not enough args supplied")
+        arg = args[n_args]
+        n_args += 1
+        ch = fmt[i]
+        i += 1
 
         if ch == 'B':
-            out += b'\x02\x01' + struct.pack('B', arg)
+            parts.append(_ASN_INT1.pack(0x0201, arg))
         elif ch == 'H':
-            out += b'\x02\x02' + struct.pack('>H', arg)
+            parts.append(_ASN_INT2.pack(0x0202, arg))
         elif ch == 'L':
-            out += b'\x02\x04' + struct.pack('>L', arg)
+            parts.append(asn_int4(arg))
         elif ch == 's':
-            out += _pack_string(arg, fmt, 'B')
+            length, i = _take_length(fmt, i)
+            parts.append(_pack_string(arg, length, 'B'))
         elif ch == 'S':
-            elem_type = fmt.pop(0)
-            out += _pack_string(arg, fmt, elem_type)
+            elem_type = fmt[i]
+            length, i = _take_length(fmt, i + 1)
+            parts.append(_pack_string(arg, length, elem_type))
         else:
             raise ValueError("Unknown format char '%s'" % ch)
 
-    if len(args):
+    if n_args < len(args):
         raise ValueError("Too many args supplied")
 
-    return out
+    return b''.join(parts)
+
+
+# pure Python versions, kept reachable for the parity test
+_py_pack = pack
+_py_unpack = unpack
+
+try:
+    # compiled pack()/unpack(), built with `make asn1`
+    from _asn1 import pack, unpack  # noqa: F811
+except ImportError:
+    pass
 
 
 def bytes_to_ipv4(data):
-    return ipaddress.IPv4Address(int(binascii.hexlify(data), 16))
+    return ipaddress.IPv4Address(int.from_bytes(data, 'big'))
 
 
 def bytes_to_ipv6(data):
-    return ipaddress.IPv6Address(int(binascii.hexlify(data), 16))
+    return ipaddress.IPv6Address(int.from_bytes(data, 'big'))
+
+
+def _attach_apn_config_args(apn_string):
+    return [0, b'\0' * 257, 0, b'\0' * 65, b'\0' * 65, b'\0' * 250, 0, b'\0' * 250, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, b'\0' * 20, 0, b'\0' * 101, b'\0' * 257, 0, b'\0' * 65, b'\0' * 65, b'\0' * 250, 0, b'\0' * 250, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, b'\0' * 20, 0, b'\0' * 101,
+            b'\0' * 257, 0, b'\0' * 65, b'\0' * 65, b'\0' * 250, 0, b'\0' * 250, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0x404, 1, 0, 1, 0, 0, b'\0' * 20, 3, apn_string, b'\0' * 257, 0, b'\0' * 65, b'\0' * 65, b'\0' * 250, 0, b'\0' * 250, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0x404, 1, 0, 1, 0, 0, b'\0' * 20, 3, apn_string, 3, 0, ]
+
+
+_ATTACH_APN_CONFIG_TYPES = 'Bs260Ls66s65s250Bs252HLLLLLLLLLLLLLLLLLLLLLs20Ls104s260Ls66s65s250Bs252HLLLLLLLLLLLLLLLLLLLLLs20Ls104s260Ls66s65s250Bs252HLLLLLLLLLLLLLLLLLLLLLs20Ls104s260Ls66s65s250Bs252HLLLLLLLLLLLLLLLLLLLLLs20Ls103BL'
+# Pack the request once with a marker in place of the APN, then only
+# splice the real APN into the two marker positions at call time.
+_APN_LEN = 101
+_APN_MARKER = b'\xa5' * _APN_LEN
+_ATTACH_APN_CONFIG_TEMPLATE = pack(
+    _ATTACH_APN_CONFIG_TYPES, *_attach_apn_config_args(_APN_MARKER))
+_APN_OFF1 = _ATTACH_APN_CONFIG_TEMPLATE.find(_APN_MARKER)
+_APN_OFF2 = _ATTACH_APN_CONFIG_TEMPLATE.find(
+    _APN_MARKER, _APN_OFF1 + _APN_LEN)
+assert _APN_OFF1 >= 0 and _APN_OFF2 >= 0
 
 
 def pack_UtaMsCallPsAttachApnConfigReq(apn):
-    apn_string = bytearray(101)
-    apn_string[:len(apn)] = apn.encode('ascii')
+    apn_string = apn.encode('ascii')
+    assert len(apn_string) <= _APN_LEN
+    apn_string = apn_string.ljust(_APN_LEN, b'\0')
 
-    args = [0, b'\0' * 257, 0, b'\0' * 65, b'\0' * 65, b'\0' * 250, 0, b'\0' * 250, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, b'\0' * 20, 0, b'\0' * 101, b'\0' * 257, 0, b'\0' * 65, b'\0' * 65, b'\0' * 250, 0, b'\0' * 250, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, b'\0' * 20, 0, b'\0' * 101,
-            b'\0' * 257, 0, b'\0' * 65, b'\0' * 65, b'\0' * 250, 0, b'\0' * 250, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0x404, 1, 0, 1, 0, 0, b'\0' * 20, 3, apn_string, b'\0' * 257, 0, b'\0' * 65, b'\0' * 65, b'\0' * 250, 0, b'\0' * 250, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0x404, 1, 0, 1, 0, 0, b'\0' * 20, 3, apn_string, 3, 0, ]
+    buf = bytearray(_ATTACH_APN_CONFIG_TEMPLATE)
+    mv = memoryview(buf)
+    mv[_APN_OFF1:_APN_OFF1 + _APN_LEN] = apn_string
+    mv[_APN_OFF2:_APN_OFF2 + _APN_LEN] = apn_string
+    return bytes(buf)
 
-    types = 'Bs260Ls66s65s250Bs252HLLLLLLLLLLLLLLLLLLLLLs20Ls104s260Ls66s65s250Bs252HLLLLLLLLLLLLLLLLLLLLLs20Ls104s260Ls66s65s250Bs252HLLLLLLLLLLLLLLLLLLLLLs20Ls104s260Ls66s65s250Bs252HLLLLLLLLLLLLLLLLLLLLLs20Ls103BL'
-    return pack(types, *args)
+
+# requests without parameters are packed once, at import time
+_NET_ATTACH_REQ = pack('BLLLLHHLL', 0, 0, 0, 0, 0, 0xffff, 0xffff, 0, 0)
 
 
 def pack_UtaMsNetAttachReq():
-    return pack('BLLLLHHLL', 0, 0, 0, 0, 0, 0xffff, 0xffff, 0, 0)
+    return _NET_ATTACH_REQ
+
+
+_GET_NEG_IP_ADDR_REQ = pack('BLL', 0, 0, 0)
 
 
 def pack_UtaMsCallPsGetNegIpAddrReq():
-    return pack('BLL', 0, 0, 0)
+    return _GET_NEG_IP_ADDR_REQ
 
 
 def unpack_UtaMsCallPsGetNegIpAddrReq(data):
@@ -300,8 +357,11 @@ def unpack_UtaMsCallPsGetNegIpAddrReq(data):
     return a1, a2, a3
 
 
+_GET_NEGOTIATED_DNS_REQ = pack('BLL', 0, 0, 0)
+
+
 def pack_UtaMsCallPsGetNegotiatedDnsReq():
-    return pack('BLL', 0, 0, 0)
+    return _GET_NEGOTIATED_DNS_REQ
 
 
 def unpack_UtaMsCallPsGetNegotiatedDnsReq(data):
@@ -318,10 +378,14 @@ def unpack_UtaMsCallPsGetNegotiatedDnsReq(data):
     return {'v4': v4, 'v6': v6}
 
 
+_CONNECT_REQ = pack('BLLL', 0, 6, 0, 0)
+
+
 def pack_UtaMsCallPsConnectReq():
-    return pack('BLLL', 0, 6, 0, 0)
+    return _CONNECT_REQ
 
 
+@functools.lru_cache(maxsize=8)
 def pack_UtaRPCPsConnectToDatachannelReq(path='/sioscc/PCIE/IOSM/IPS/0'):
     bpath = path.encode('ascii') + b'\0'
     return pack('s24', bpath)
@@ -384,11 +448,11 @@ def do_fcc_unlock(r):
 
     fcc_chal_resp = r.execute('CsiFccLockGenChallengeReq', is_async=True)
     _, fcc_chal = unpack('nn', fcc_chal_resp['body'])
-    chal_bytes = struct.pack('<L', fcc_chal)
+    chal_bytes = _S_LE_L.pack(fcc_chal)
     # read out from nvm:fix_cat_fcclock.fcclock_hash[0]={0x3D,0xF8,0xC7,0x19}
     key = bytearray([0x3d, 0xf8, 0xc7, 0x19])
     resp_bytes = hashlib.sha256(chal_bytes + key).digest()
-    resp = struct.unpack('<L', resp_bytes[:4])[0]
+    resp, = _S_LE_L.unpack_from(resp_bytes, 0)
     unlock_resp = r.execute('CsiFccLockVerChallengeReq',
                             pack('L', resp), is_async=True)
     resp = unpack('n', unlock_resp['body'])[0]
@@ -400,7 +464,7 @@ if __name__ == "__main__":
     rpc = XMMRPC()
 
     fcc_status = rpc.execute('CsiFccLockQueryReq', is_async=True)
-    print("fcc status: %s" % binascii.hexlify(fcc_status['body']))
+    print("fcc status: %s" % fcc_status['body'].hex())
 
     rpc.execute('UtaMsSmsInit')
     rpc.execute('UtaMsCbsInit')
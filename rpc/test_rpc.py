@@ -1,5 +1,6 @@
 import rpc
 import binascii
+import struct
 
 
 def test_pack_UtaMsCallPsAttachApnConfigReq():
@@ -191,6 +192,139 @@ def test_pack_UtaMsCallPsConnectReq():
     assert rpc.pack_UtaMsCallPsConnectReq() == binascii.unhexlify(expected)
 
 
+def test_pack_wide_strings():
+    assert rpc.pack('SH3', [1, 0x203]) == binascii.unhexlify(
+        '5602020400000006020400000002' + '01000302' + '0000')
+    assert rpc.pack('SL2', [1]) == binascii.unhexlify(
+        '5701020400000008020400000004' + '01000000' + '00000000')
+
+
+def test_unpack():
+    data = rpc.pack('Ls4HL', 0x11000101, b'ab', 0x404, 3)
+    assert rpc.unpack('nsnn', data) == [0x11000101, b'ab', 0x404, 3]
+    assert rpc.unpack_unknown(data) == [0x11000101, b'ab', 0x404, 3]
+
+
+def test_unpack_long_string():
+    # take_string reads the long form length little endian, while
+    # _pack_string writes it big endian, so decode a hand-written vector:
+    # 300 (0x012c) valid bytes, count 300, padding 0
+    val = bytes(range(256)) + bytes(range(44))
+    data = binascii.unhexlify('55822c01' '02040000012c' '020400000000') + \
+        val + rpc.asn_int4(7)
+    assert rpc.unpack('sn', data) == [val, 7]
+
+
+def test_handle_message():
+    r = rpc.XMMRPC.__new__(rpc.XMMRPC)
+    body = rpc.asn_int4(0x11000101) + rpc.asn_int4(5)
+    total_length = len(body) + 16
+    message = struct.pack('<L', total_length) + rpc.asn_int4(total_length) + \
+        rpc.asn_int4(0x10) + struct.pack('>L', 0x11000101) + body
+    buf = bytearray(message)
+    resp = r.handle_message(memoryview(buf))
+    buf[:] = bytes(len(buf))
+    assert resp['type'] == 'response'
+    assert resp['tid'] == 0x11000101
+    assert resp['code'] == 0x10
+    assert resp['content'] == [5]
+    assert resp['body'] == rpc.asn_int4(5)
+
+
+def test_unpack_UtaMsCallPsGetNegotiatedDnsReq():
+    v4 = bytes([8, 8, 4, 4]).ljust(16, b'\0')
+    v6 = binascii.unhexlify('20014860486000000000000000008888')
+    args = [0]
+    for i in range(16):
+        if i == 0:
+            args += [v4, 1]
+        elif i == 1:
+            args += [v6, 2]
+        else:
+            args += [b'\0' * 16, 0]
+    args += [0, b'', 0, 0, 0, 0]
+    data = rpc.pack('L' + 's16L' * 16 + 'Ls0LLLL', *args)
+    dns = rpc.unpack_UtaMsCallPsGetNegotiatedDnsReq(data)
+    assert [str(a) for a in dns['v4']] == ['8.8.4.4']
+    assert [str(a) for a in dns['v6']] == ['2001:4860:4860::8888']
+
+
+def test_unpack_UtaMsCallPsGetNegIpAddrReq():
+    addresses = bytes([0, 0, 0, 0, 0, 0, 0, 0, 10, 1, 2, 3]).ljust(16, b'\0')
+    data = rpc.pack('Ls16LLLL', 0, addresses, 0, 0, 0, 0)
+    ips = rpc.unpack_UtaMsCallPsGetNegIpAddrReq(data)
+    assert [str(a) for a in ips] == ['0.0.0.0', '0.0.0.0', '10.1.2.3']
+
+    # the address string is variable length, short ones must still parse
+    data = rpc.pack('Ls10LLLL', 0, bytes(range(1, 11)), 0, 0, 0, 0)
+    ips = rpc.unpack_UtaMsCallPsGetNegIpAddrReq(data)
+    assert [str(a) for a in ips] == ['1.2.3.4', '5.6.7.8', '0.0.9.10']
+
+
+def _outcome(func, *args):
+    try:
+        return func(*args)
+    except Exception as e:
+        return type(e), str(e)
+
+
+def test_asn1_parity():
+    try:
+        import _asn1
+    except ImportError:
+        return  # not built, see `make asn1`
+
+    pack_vectors = [
+        (rpc._ATTACH_APN_CONFIG_TYPES,) + tuple(rpc._attach_apn_config_args(b'x' * 101)),
+        ('BHL', 255, 65535, 2**32 - 1),
+        ('BL', True, 0),
+        ('s24', b'/sioscc/PCIE/IOSM/IPS/0\0'),
+        ('s300L', bytearray(b'a' * 300), 1),
+        ('s4', [1, 2]),
+        ('SH3', [1, 0x203]),
+        ('SL2', [1]),
+        ('SQ2', [1]),
+        ('Ls0L', 0, b'', 3),
+        ('L', 1.5),
+        ('L', -1),
+        ('L', 2**32),
+        ('L', 2**64),
+        ('B', 256),
+        ('H', -1),
+        ('L',),
+        ('L', 1, 2),
+        ('x', 1),
+        ('s', b''),
+        ('S', [1]),
+        ('s2', b'abc'),
+        ('s4', 'abc'),
+        ('s4', [1, 300]),
+    ]
+    for vector in pack_vectors:
+        assert _outcome(rpc._py_pack, *vector) == _outcome(_asn1.pack, *vector), vector[0]
+
+    unpack_vectors = [
+        ('nsnn', rpc._py_pack('Ls4HL', 0x11000101, b'ab', 0x404, 3)),
+        ('sn', rpc._py_pack('s300L', b'b' * 300, 7)),
+        ('n', binascii.unhexlify('020a0102030405060708090a')),
+        ('n', b'\x02\x01'),
+        ('n', b'\x02'),
+        ('n', b''),
+        ('nn', b'\x02\x01\x05'),
+        ('n', b'\x03\x01\x05'),
+        ('s', b'\x54'),
+        ('s', binascii.unhexlify('5582010102040000000002040000000061')),
+        ('s', binascii.unhexlify('5502020400000008020400000004616263')),
+        ('sn', binascii.unhexlify('550202040000000002040fffffff61620201ff')),
+        ('sn', binascii.unhexlify('55020204000000000208ffffffffffffffff6162')),
+        ('s', binascii.unhexlify('5703020400000010020400000004')),
+        ('nx', b'\x02\x01\x05'),
+    ]
+    for fmt, data in unpack_vectors:
+        for buf in (data, bytearray(data), memoryview(data)):
+            assert _outcome(rpc._py_unpack, fmt, buf) == _outcome(_asn1.unpack, fmt, buf), (fmt, data)
+
+
 if __name__ == "__main__":
     print("running rpc tests")
     test_pack_UtaMsCallPsAttachApnConfigReq()
@@ -198,3 +332,10 @@ if __name__ == "__main__":
     test_pack_UtaMsNetAttachReq()
     test_pack_UtaMsCallPsGetNegIpAddrReq()
     test_pack_UtaMsCallPsConnectReq()
+    test_pack_wide_strings()
+    test_unpack()
+    test_unpack_long_string()
+    test_handle_message()
+    test_unpack_UtaMsCallPsGetNegotiatedDnsReq()
+    test_unpack_UtaMsCallPsGetNegIpAddrReq()
+    test_asn1_parity()